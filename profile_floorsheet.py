@@ -0,0 +1,38 @@
+"""
+Profile a single-date scrape to see whether the browser/network round-trips
+or the parsing and cleaning dominate.
+
+    START_DATE=2024-01-15 python profile_floorsheet.py
+
+Prints the top 30 functions by cumulative time and keeps the raw stats in
+prof.out (open with `snakeviz prof.out`). Output files go to a throwaway
+directory, so existing outputs are neither skipped nor overwritten.
+"""
+import cProfile
+import os
+import pstats
+import tempfile
+from datetime import datetime
+
+import python_scrape_floorsheet as scraper
+
+
+def main():
+    run_date = os.getenv("START_DATE") or datetime.now(scraper.NPT).strftime("%Y-%m-%d")
+    stats_path = os.getenv("PROFILE_OUT", "prof.out")
+
+    with tempfile.TemporaryDirectory(prefix="floorsheet-profile-") as out_dir:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            scraper.run_worker(0, [run_date], out_dir)
+        finally:
+            profiler.disable()
+
+    profiler.dump_stats(stats_path)
+    print(f"Profile for {run_date} saved to {stats_path}")
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(30)
+
+
+if __name__ == "__main__":
+    main()
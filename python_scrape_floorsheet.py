@@ -1,21 +1,109 @@
+import json
+import logging
 import os
 import re
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
+from itertools import chain, repeat
 
+import orjson
 import pandas as pd
-from bs4 import BeautifulSoup
+import requests
+import urllib3
+from selectolax.parser import HTMLParser
 
 from selenium import webdriver
+from selenium.webdriver.chrome.remote_connection import ChromeRemoteConnection
+from selenium.webdriver.chrome.service import Service as ChromeService
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
-from selenium.common.exceptions import StaleElementReferenceException, TimeoutException
+from selenium.common.exceptions import (
+    InvalidSessionIdException,
+    NoSuchWindowException,
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.remote.remote_connection import LOGGER as SELENIUM_LOGGER
+
 
+# Selenium logs every wire command at DEBUG; keep only real problems
+SELENIUM_LOGGER.setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
 
 URL = "https://chukul.com/floorsheet"
 
+# NEPSE trades on Nepal time
+NPT = timezone(timedelta(hours=5, minutes=45))
+
+# JSON endpoint behind the floorsheet table. When set, dates are fetched over
+# plain HTTP and the browser is only started as a fallback.
+API_URL = os.getenv("FLOORSHEET_API_URL", "").strip()
+API_PAGE_SIZE = int(os.getenv("FLOORSHEET_API_PAGE_SIZE", "500"))
+API_PAGE_WORKERS = int(os.getenv("FLOORSHEET_API_PAGE_WORKERS", "8"))
+# Far above a real day's page count; past it the endpoint isn't paging
+API_MAX_PAGES = int(os.getenv("FLOORSHEET_API_MAX_PAGES", "1000"))
+
+# Requests in flight across all date workers together, to go easy on the
+# server however many dates run at once
+API_SEMAPHORE = threading.BoundedSemaphore(max(1, API_PAGE_WORKERS))
+
+# JSON keys that map onto HEADER, in order, for endpoints returning objects
+# with extra fields (e.g. "contract_id,symbol,buyer,seller,qty,rate,amount")
+API_FIELDS = [f.strip() for f in os.getenv("FLOORSHEET_API_FIELDS", "").split(",") if f.strip()]
+
+# Subresources the table never needs. Stylesheets are only blocked on
+# request (FLOORSHEET_BLOCK_CSS=1): the date picker's visibility checks
+# depend on Quasar's layout.
+BLOCKED_URL_PATTERNS = (
+    "*.png", "*.jpg", "*.jpeg", "*.gif", "*.svg", "*.ico", "*.webp",
+    "*.woff", "*.woff2", "*.ttf",
+    "*google-analytics*", "*googletagmanager*", "*gtag*", "*doubleclick*",
+)
+
+# Scrape dates again even if their CSV already exists
+FORCE_RESCRAPE = os.getenv("FORCE_RESCRAPE") == "1"
+
+# Parallel Chrome instances allowed, including API workers that fell back
+# to the browser
+MAX_BROWSER_WORKERS = 5
+BROWSER_SLOTS = threading.BoundedSemaphore(MAX_BROWSER_WORKERS)
+
+# Chrome grows over a long backfill; replace it after this many dates or
+# seconds, whichever comes first
+BROWSER_MAX_DATES = int(os.getenv("BROWSER_MAX_DATES", "50"))
+BROWSER_MAX_AGE = int(os.getenv("BROWSER_MAX_AGE", "600"))
+
+# Persistent Chrome profiles (one per worker slot); empty disables them
+CHROME_PROFILE_DIR = os.getenv(
+    "CHROME_PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".chrome-profile")
+)
+
+# Keep the browser alive between runs and attach to it next time
+REUSE_BROWSER = os.getenv("REUSE_BROWSER") == "1"
+
+HEADER = ["Transact No.", "Symbol", "Buyer", "Seller", "Quantity", "Rate", "Amount"]
+NUMERIC_COLUMNS = ("Quantity", "Rate", "Amount")
+CATEGORY_COLUMNS = ("Symbol", "Buyer", "Seller")
+
+# Files written per date: comma-separated "csv" and/or "parquet" (zstd).
+# FLOORSHEET_PARQUET=1 is the older spelling of "csv,parquet".
+OUTPUT_FORMATS = [
+    f.strip().lower()
+    for f in os.getenv(
+        "OUTPUT_FORMAT", "csv,parquet" if os.getenv("FLOORSHEET_PARQUET") == "1" else "csv"
+    ).split(",")
+    if f.strip()
+]
+
 # ----------------------------
 # DATE PICKER (stable selectors)
 # ----------------------------
@@ -36,6 +124,10 @@ NAV_YEAR_BTN_XPATH = (
     "and translate(normalize-space(.),'0123456789','')='']]"
 )
 
+# Date-picker transitions take well under a second; poll for them faster than
+# WebDriverWait's 0.5 s default instead of sleeping blindly.
+POLL_FREQUENCY = 0.1
+
 MONTH_ABBR = {
     1: "JAN", 2: "FEB", 3: "MAR", 4: "APR",
     5: "MAY", 6: "JUN", 7: "JUL", 8: "AUG",
@@ -43,7 +135,7 @@ MONTH_ABBR = {
 }
 
 
-def retry_on_stale(fn, tries=4, sleep=0.2):
+def retry_on_stale(fn, tries=4, sleep=0.05):
     for i in range(tries):
         try:
             return fn()
@@ -53,8 +145,19 @@ def retry_on_stale(fn, tries=4, sleep=0.2):
             time.sleep(sleep)
 
 
+def wait_briefly(driver, condition, timeout=5, poll_frequency=POLL_FREQUENCY):
+    """
+    Wait for a UI transition that is expected but not essential; returns
+    None instead of raising if it doesn't happen in time.
+    """
+    try:
+        return WebDriverWait(driver, timeout, poll_frequency=poll_frequency).until(condition)
+    except TimeoutException:
+        return None
+
+
 def wait_qdate(driver, timeout=20):
-    return WebDriverWait(driver, timeout).until(
+    return WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY).until(
         EC.presence_of_element_located((By.CSS_SELECTOR, QDATE_ROOT_CSS))
     )
 
@@ -69,20 +172,36 @@ def close_calendar(driver):
             driver.find_element(By.TAG_NAME, "body").send_keys(Keys.ESCAPE)
         except Exception:
             pass
-        for _ in range(20):
-            if not is_calendar_open(driver):
-                return
-            time.sleep(0.1)
+        wait_briefly(driver, lambda d: not is_calendar_open(d), timeout=2)
+
+
+# Same match as //input[(@type='text' or not(@type))], via the browser's
+# native selector engine instead of an XPath document scan
+DATE_INPUT_CSS = "input[type='text'], input:not([type])"
+
+_DATE_VALUE_RE = re.compile(r"\d{4}/\d{2}/\d{2}|\d{4}-\d{2}-\d{2}")
 
 
 def find_date_input(driver):
-    inputs = driver.find_elements(By.XPATH, "//input[(@type='text' or not(@type))]")
+    # The scan below costs several round-trips per input, and this is called
+    # on every poll of the date waits; keep the element until it goes stale.
+    cached = getattr(driver, "_floorsheet_date_input", None)
+    if cached is not None:
+        try:
+            if cached.is_displayed():
+                return cached
+        except StaleElementReferenceException:
+            pass
+        driver._floorsheet_date_input = None
+
+    inputs = driver.find_elements(By.CSS_SELECTOR, DATE_INPUT_CSS)
     for el in inputs:
         try:
             if not (el.is_displayed() and el.is_enabled()):
                 continue
             val = (el.get_attribute("value") or "").strip()
-            if re.fullmatch(r"\d{4}/\d{2}/\d{2}", val) or re.fullmatch(r"\d{4}-\d{2}-\d{2}", val):
+            if _DATE_VALUE_RE.fullmatch(val):
+                driver._floorsheet_date_input = el
                 return el
         except Exception:
             pass
@@ -100,11 +219,11 @@ def open_calendar(driver, timeout=20):
     driver.execute_script("arguments[0].click();", el)
 
     wait_qdate(driver, timeout)
-    time.sleep(0.1)
+    wait_briefly(driver, EC.visibility_of_element_located((By.CSS_SELECTOR, QDATE_ROOT_CSS)))
 
 
 def ensure_month_grid_open(driver, timeout=20):
-    wait = WebDriverWait(driver, timeout)
+    wait = WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY)
 
     def _try_open():
         if driver.find_elements(By.CSS_SELECTOR, f"{QDATE_ROOT_CSS} {MONTH_VIEW_CSS}"):
@@ -121,7 +240,6 @@ def ensure_month_grid_open(driver, timeout=20):
             return retry_on_stale(_try_open)
         except (TimeoutException, StaleElementReferenceException):
             close_calendar(driver)
-            time.sleep(0.2)
             open_calendar(driver, timeout=timeout)
 
     raise TimeoutException("Month grid (JAN-DEC) did not open after retries.")
@@ -132,14 +250,27 @@ def get_current_year(driver, timeout=20) -> int:
     return int(root.find_element(By.CSS_SELECTOR, YEAR_HEADER_CSS).text.strip())
 
 
+VISIBLE_YEARS_JS = f"""
+return Array.from(document.querySelectorAll('{QDATE_ROOT_CSS} {YEAR_VIEW_CSS} span'))
+    .map(sp => sp.innerText.trim())
+    .filter(t => /^\\d{{4}}$/.test(t))
+    .map(Number);
+"""
+
+
+def visible_years(driver):
+    # One script call instead of a .text round-trip per year cell
+    return driver.execute_script(VISIBLE_YEARS_JS) or []
+
+
 def set_year(driver, year: int, timeout=20):
-    wait = WebDriverWait(driver, timeout)
+    wait = WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY)
+    year_view = (By.CSS_SELECTOR, f"{QDATE_ROOT_CSS} {YEAR_VIEW_CSS}")
 
     ybtn = wait.until(EC.element_to_be_clickable((By.XPATH, NAV_YEAR_BTN_XPATH)))
     driver.execute_script("arguments[0].click();", ybtn)
 
-    wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, f"{QDATE_ROOT_CSS} {YEAR_VIEW_CSS}")))
-    time.sleep(0.1)
+    wait.until(EC.presence_of_element_located(year_view))
 
     year_xpath = (
         "//div[contains(@class,'q-date__years-content')]"
@@ -149,40 +280,48 @@ def set_year(driver, year: int, timeout=20):
     prev_arrow = ".//div[contains(@class,'q-date__years-content')]//button[.//i[normalize-space(.)='chevron_left']]"
     next_arrow = ".//div[contains(@class,'q-date__years-content')]//button[.//i[normalize-space(.)='chevron_right']]"
 
+    def _page(arrow, years):
+        root = wait_qdate(driver, timeout)
+        driver.execute_script("arguments[0].click();", root.find_element(By.XPATH, arrow))
+        # Wait for the grid to page to the next block of years
+        wait_briefly(driver, lambda d: visible_years(d) != years)
+        return visible_years(driver)
+
+    # Work out how many grid pages away the target is from one read, then
+    # page straight there instead of re-reading the grid before every click
+    years = visible_years(driver)
+    if years and not min(years) <= year <= max(years):
+        per_page = len(years)
+        if year < min(years):
+            steps, arrow = -(-(min(years) - year) // per_page), prev_arrow
+        else:
+            steps, arrow = -(-(year - max(years)) // per_page), next_arrow
+        for _ in range(steps):
+            years = _page(arrow, years)
+
     for _ in range(35):
         root = wait_qdate(driver, timeout)
         found = root.find_elements(By.XPATH, year_xpath)
         if found:
             driver.execute_script("arguments[0].click();", found[0])
-            time.sleep(0.12)
+            wait_briefly(driver, EC.invisibility_of_element_located(year_view))
             return
 
-        years = []
-        for sp in root.find_elements(By.XPATH, ".//div[contains(@class,'q-date__years-content')]//span"):
-            t = (sp.text or "").strip()
-            if t.isdigit() and len(t) == 4:
-                years.append(int(t))
-
-        if years and year < min(years):
-            driver.execute_script("arguments[0].click();", root.find_element(By.XPATH, prev_arrow))
-        else:
-            driver.execute_script("arguments[0].click();", root.find_element(By.XPATH, next_arrow))
-
-        time.sleep(0.10)
+        # Grid not where the arithmetic said; step one page at a time
+        years = _page(prev_arrow if years and year < min(years) else next_arrow, years)
 
     raise RuntimeError(f"Year {year} not found in grid.")
 
 
 def set_month(driver, month: int, timeout=20):
     abbr = MONTH_ABBR[month]
-    wait = WebDriverWait(driver, timeout)
+    wait = WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY)
+    month_view_loc = (By.CSS_SELECTOR, f"{QDATE_ROOT_CSS} {MONTH_VIEW_CSS}")
 
     def _do():
         ensure_month_grid_open(driver, timeout=timeout)
 
-        month_view = wait.until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, f"{QDATE_ROOT_CSS} {MONTH_VIEW_CSS}"))
-        )
+        month_view = wait.until(EC.presence_of_element_located(month_view_loc))
 
         month_btn_xpath = (
             ".//button[.//span[translate(normalize-space(.),"
@@ -190,17 +329,29 @@ def set_month(driver, month: int, timeout=20):
             f"='{abbr}']]"
         )
 
-        btn = WebDriverWait(month_view, timeout).until(
+        btn = WebDriverWait(month_view, timeout, poll_frequency=POLL_FREQUENCY).until(
             EC.element_to_be_clickable((By.XPATH, month_btn_xpath))
         )
         driver.execute_script("arguments[0].click();", btn)
-        time.sleep(0.1)
+        wait_briefly(driver, EC.invisibility_of_element_located(month_view_loc))
 
     return retry_on_stale(_do)
 
 
-def click_day(driver, day: int, timeout=20):
-    wait = WebDriverWait(driver, timeout)
+def date_input_matches(driver, target_ymd: str):
+    el = find_date_input(driver)
+    if not el:
+        return False
+    try:
+        v = (el.get_attribute("value") or "").strip()
+    except StaleElementReferenceException:
+        driver._floorsheet_date_input = None
+        return False
+    return v in (target_ymd, target_ymd.replace("-", "/"))
+
+
+def click_day(driver, day: int, timeout=20, target_ymd=None):
+    wait = WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY)
 
     def _do():
         day_view = wait.until(
@@ -212,11 +363,17 @@ def click_day(driver, day: int, timeout=20):
             f"//button[.//span[normalize-space(text())='{day}']]"
         )
 
-        btn = WebDriverWait(day_view, timeout).until(
+        btn = WebDriverWait(day_view, timeout, poll_frequency=POLL_FREQUENCY).until(
             EC.element_to_be_clickable((By.XPATH, day_btn_xpath))
         )
         driver.execute_script("arguments[0].click();", btn)
-        time.sleep(0.15)
+
+        # Give the picker a moment to commit the click before confirming
+        wait_briefly(
+            driver,
+            lambda d: not is_calendar_open(d) or (target_ymd is not None and date_input_matches(d, target_ymd)),
+            timeout=1,
+        )
 
         try:
             driver.switch_to.active_element.send_keys(Keys.ENTER)
@@ -227,29 +384,90 @@ def click_day(driver, day: int, timeout=20):
 
 
 def wait_date_applied(driver, target_ymd: str, timeout=30):
-    wait = WebDriverWait(driver, timeout)
-    target_slash = target_ymd.replace("-", "/")
+    wait = WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY)
+    wait.until(lambda d: date_input_matches(d, target_ymd))
 
-    def _ok(d):
-        el = find_date_input(d)
-        if not el:
-            return False
+
+# Assign through the native setter so Vue's v-model sees the input event
+SET_INPUT_VALUE_JS = """
+const el = arguments[0];
+const setter = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+setter.call(el, arguments[1]);
+el.dispatchEvent(new Event('input', {bubbles: true}));
+el.dispatchEvent(new Event('change', {bubbles: true}));
+"""
+
+
+def selected_year_month(driver):
+    el = find_date_input(driver)
+    if not el:
+        return None
+    try:
         v = (el.get_attribute("value") or "").strip()
-        return (v == target_slash) or (v == target_ymd)
+    except StaleElementReferenceException:
+        return None
+    if not _DATE_VALUE_RE.fullmatch(v):
+        return None
+    return int(v[:4]), int(v[5:7])
 
-    wait.until(_ok)
+
+def set_date_directly(driver, date_str: str, timeout=8):
+    """
+    Type the date straight into the bound input instead of clicking through
+    the calendar. Only trusted once the table has visibly reloaded; returns
+    False so the caller can fall back to the click path. A page that ignored
+    it once is not asked again, so later dates don't pay the timeout.
+    """
+    if getattr(driver, "_floorsheet_direct_set_failed", False):
+        return False
+
+    el = find_date_input(driver)
+    before = first_row_key(driver)
+    if not el or not before:
+        return False
+
+    current = (el.get_attribute("value") or "").strip()
+    value = date_str.replace("-", "/") if "/" in current else date_str
+    driver.execute_script(SET_INPUT_VALUE_JS, el, value)
+
+    reloaded = wait_briefly(
+        driver,
+        lambda d: date_input_matches(d, date_str) and first_row_key(d) != before,
+        timeout=timeout,
+    )
+    if reloaded:
+        return True
+
+    driver._floorsheet_direct_set_failed = True
+    # Put back what was overwritten: the click path reads the input to
+    # decide which month the calendar opens on
+    try:
+        driver.execute_script(SET_INPUT_VALUE_JS, el, current)
+    except WebDriverException:
+        pass
+    return False
 
 
 def pick_date(driver, date_str: str, timeout=30):
     dt = datetime.strptime(date_str, "%Y-%m-%d")
 
+    close_calendar(driver)
+    if set_date_directly(driver, date_str):
+        return
+
+    # The calendar opens on the month of the selected date, so consecutive
+    # dates in the same month only need the day click.
+    shown = selected_year_month(driver)
+
     open_calendar(driver, timeout=timeout)
 
-    if get_current_year(driver, timeout=timeout) != dt.year:
-        set_year(driver, dt.year, timeout=timeout)
+    if shown != (dt.year, dt.month):
+        if get_current_year(driver, timeout=timeout) != dt.year:
+            set_year(driver, dt.year, timeout=timeout)
 
-    set_month(driver, dt.month, timeout=timeout)
-    click_day(driver, dt.day, timeout=timeout)
+        set_month(driver, dt.month, timeout=timeout)
+
+    click_day(driver, dt.day, timeout=timeout, target_ymd=date_str)
 
     wait_date_applied(driver, date_str, timeout=timeout)
     WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.CSS_SELECTOR, "table")))
@@ -258,35 +476,132 @@ def pick_date(driver, date_str: str, timeout=30):
 # ----------------------------
 # SCRAPE HELPERS
 # ----------------------------
-def parse_numeric(value):
-    if value is None:
-        return None
-    s = str(value).strip()
-    if not s:
-        return None
-    clean = "".join(c for c in s if c.isdigit() or c == ".")
+# Anything but digits and the decimal point ("1,234.50" -> "1234.50")
+_NUM_CLEAN = re.compile(r"[^0-9.]")
+
+
+# Row cells of the first table, read in the browser: one small JSON reply
+# instead of serialising the whole DOM through page_source.
+EXTRACT_ROWS_FN = """
+function extractRows() {
+    const table = document.querySelector('table');
+    if (!table) return [];
+    return Array.from(table.querySelectorAll('tr'))
+        .map(tr => Array.from(tr.querySelectorAll(':scope > td')).map(td => td.innerText.trim()))
+        .filter(cells => cells.length);
+}
+"""
+
+TABLE_ROWS_JS = EXTRACT_ROWS_FN + "return extractRows();"
+
+# Walk every page inside the browser and hand back all of them at once.
+# arguments: total pages (or null), per-page timeout in ms, callback.
+SCRAPE_ALL_PAGES_JS = EXTRACT_ROWS_FN + """
+const [totalPages, pageTimeout, done] = arguments;
+
+const firstKey = () => {
+    const td = document.querySelector('table tbody tr td');
+    return td ? td.innerText.trim().split(/\\s+/).join(' ') : null;
+};
+const pagerButtons = () => Array.from(document.querySelectorAll('div.q-pagination button'))
+    .filter(b => !(b.disabled || b.classList.contains('disabled') || b.getAttribute('aria-disabled') === 'true'));
+const numberedNext = page => pagerButtons().find(b => b.innerText.trim() === String(page + 1));
+const arrowNext = () => pagerButtons()
+    .find(b => /^(chevron_right|keyboard_arrow_right|navigate_next)$/.test(b.innerText.trim()));
+// Resolve on the first DOM mutation that changes the first row instead of
+// re-reading it on a timer. The whole table is observed because Vue may
+// swap the tbody out rather than patch it.
+const pageChanged = (before, timeoutMs) => new Promise(resolve => {
+    const table = document.querySelector('table');
+    if (!table || firstKey() !== before) return resolve(true);
+    const finish = ok => { observer.disconnect(); clearTimeout(timer); resolve(ok); };
+    const observer = new MutationObserver(() => {
+        if (firstKey() !== before) finish(true);
+    });
+    const timer = setTimeout(() => finish(firstKey() !== before), timeoutMs);
+    observer.observe(table, {childList: true, subtree: true, characterData: true});
+});
+
+// Collect column-wise so Python can build the frame without transposing
+// rows; short rows are padded with null like pandas would.
+const columns = [];
+let nrows = 0;
+const addRows = rows => {
+    for (const cells of rows) {
+        while (columns.length < cells.length) columns.push(new Array(nrows).fill(null));
+        columns.forEach((col, i) => col.push(i < cells.length ? cells[i] : null));
+        nrows += 1;
+    }
+};
+
+(async () => {
+    let page = 1;
+    const finish = status => done({columns, pages: page, status});
+    while (true) {
+        addRows(extractRows());
+
+        // totalPages is only the highest number shown, and a windowed
+        // pagination hides the rest, so a numbered next button always wins.
+        // The arrow is trusted only below totalPages; some builds leave it
+        // enabled on the last page.
+        let btn = numberedNext(page);
+        if (!btn && !(totalPages && page >= totalPages)) btn = arrowNext();
+        if (!btn) return finish(totalPages && page < totalPages ? 'incomplete' : 'ok');
+
+        const before = firstKey();
+        const changed = pageChanged(before, pageTimeout);
+        btn.click();
+        if (!(await changed)) return finish('timeout');
+        page += 1;
+    }
+})().catch(e => done({columns: [], pages: 0, status: 'error: ' + e}));
+"""
+
+
+TABLE_HTML_JS = "const t = document.querySelector('table'); return t ? t.outerHTML : null;"
+
+
+def table_html(driver):
+    # Just the table's markup is a fraction of the full page_source payload
     try:
-        return float(clean) if clean else None
-    except ValueError:
-        return None
+        html = driver.execute_script(TABLE_HTML_JS)
+    except WebDriverException:
+        html = None
+    return html if html is not None else driver.page_source
 
 
-def scrape_current_page(driver):
-    soup = BeautifulSoup(driver.page_source, "html.parser")
-    table = soup.find("table")
-    if not table:
+def parse_table_html(driver):
+    table = HTMLParser(table_html(driver)).css_first("table")
+    if table is None:
         return []
 
-    rows = table.find_all("tr")
+    # Walk each row's direct children instead of a second selector query
+    # per row; this also matches the JS path's ':scope > td'.
     data = []
-    for row in rows:
-        cols = row.find_all("td")
-        cols_data = [c.get_text(strip=True) for c in cols]
+    for row in table.css("tr"):
+        cols_data = [cell.text(strip=True) for cell in row.iter() if cell.tag == "td"]
         if cols_data:
             data.append(cols_data)
     return data
 
 
+def scrape_current_page(driver):
+    """
+    Returns (rows, first_row_key) from a single round-trip, so the
+    pagination step doesn't need another one to read the key.
+    """
+    try:
+        data = driver.execute_script(TABLE_ROWS_JS)
+    except WebDriverException:
+        data = None
+    if data is None:
+        data = parse_table_html(driver)
+
+    # Normalise whitespace the way WebElement.text does
+    key = " ".join(data[0][0].split()) if data else None
+    return data, key
+
+
 def first_row_key(driver):
     try:
         return driver.find_element(By.CSS_SELECTOR, "table tbody tr td").text.strip()
@@ -294,52 +609,351 @@ def first_row_key(driver):
         return None
 
 
-def go_to_next_page(driver, wait, current_page):
+TOTAL_PAGES_JS = r"""
+const root = document.querySelector('div.q-pagination');
+if (!root) return null;
+
+// Input mode shows "current / max"
+const text = root.innerText + ' ' + Array.from(root.querySelectorAll('input'))
+    .map(i => (i.placeholder || '') + ' ' + (i.value || '')).join(' ');
+const m = text.match(/\d+\s*\/\s*(\d+)/);
+if (m) return parseInt(m[1], 10);
+
+const labels = Array.from(root.querySelectorAll('button'))
+    .map(b => b.innerText.trim())
+    .filter(t => t && !/^(chevron_|first_page|last_page|keyboard_)/.test(t));
+const nums = labels.filter(t => /^\d+$/.test(t)).map(Number);
+if (!nums.length) return null;
+
+// A trailing ellipsis means the last page number is hidden
+if (/^(\u2026|\.\.\.)$/.test(labels[labels.length - 1])) return null;
+return Math.max(...nums);
+"""
+
+
+def read_total_pages(driver):
     """
-    If pagination click doesn't change rows (Timeout), we return 'TIMEOUT'
-    so main() can skip this date safely.
+    Last page number from the pagination widget, or None if it can't be
+    told for sure. Paging never stops on it alone (a windowed pagination
+    shows only part of the range); it runs until the next button is
+    missing and reports 'incomplete' if that happens short of the total.
     """
-    target = str(current_page + 1)
+    try:
+        total = driver.execute_script(TOTAL_PAGES_JS)
+    except WebDriverException:
+        return None
+    return int(total) if total else None
 
-    buttons = driver.find_elements(
-        By.XPATH,
-        f"//div[contains(@class,'q-pagination')]//button[normalize-space()='{target}']"
-    )
 
-    if not buttons:
-        return False
+# Go back to page 1 if the pagination is still on a later page of the
+# previous date. Returns true when it had to click.
+FIRST_PAGE_JS = """
+const buttons = Array.from(document.querySelectorAll('div.q-pagination button'));
+const active = buttons.find(b => b.getAttribute('aria-current') === 'true');
+if (!active || active.innerText.trim() === '1') return false;
+const first = buttons.find(b => b.innerText.trim() === '1');
+if (!first) return false;
+first.click();
+return true;
+"""
+
 
+def ensure_first_page(driver, timeout=10):
+    """
+    A date switch on the same page normally resets paging, but nothing
+    guarantees it; starting mid-way would silently drop the earlier pages.
+    """
     before = first_row_key(driver)
-    driver.execute_script("arguments[0].click();", buttons[0])
+    if driver.execute_script(FIRST_PAGE_JS):
+        print("Pagination was not on page 1; going back.")
+        wait_briefly(driver, lambda d: first_row_key(d) != before, timeout=timeout)
+
+
+# Pick the highest numeric option in the table's rows-per-page q-select
+# ("All" only when allowed), then wait for the rows or pagination to
+# redraw. Resolves {label, changed, menuOpen}, or null when there is no such
+# control.
+MAX_ROWS_PER_PAGE_JS = """
+const [allowAll, timeoutMs, done] = arguments;
+const sleep = ms => new Promise(r => setTimeout(r, ms));
+const pager = document.querySelector('div.q-pagination');
+const select = document.querySelector('.q-table__bottom .q-select')
+    || (pager && pager.parentElement && pager.parentElement.querySelector('.q-select'));
+if (!select) return done(null);
+
+const current = select.innerText.replace(/arrow_drop_down/g, '').trim();
+const snapshot = () => document.querySelectorAll('table tbody tr').length + '|'
+    + (pager ? pager.innerText : '');
+
+(async () => {
+    (select.querySelector('.q-field__control') || select).click();
+    let options = [];
+    for (let i = 0; i < 20 && !options.length; i++) {
+        await sleep(50);
+        options = Array.from(document.querySelectorAll('.q-menu .q-item'));
+    }
+    const labelOf = o => o.innerText.trim();
+    const best = (allowAll && options.find(o => /^all$/i.test(labelOf(o))))
+        || options.filter(o => /^\\d+$/.test(labelOf(o)))
+            .sort((a, b) => Number(labelOf(b)) - Number(labelOf(a)))[0];
+    if (!best || labelOf(best) === current) {
+        // Left for Python to close with a real Escape key press
+        return done({label: best ? current : null, changed: false, menuOpen: options.length > 0});
+    }
+
+    const before = snapshot();
+    best.click();
+    const start = Date.now();
+    while (snapshot() === before && Date.now() - start < timeoutMs) await sleep(50);
+    done({label: labelOf(best), changed: true});
+})().catch(() => done(null));
+"""
+
+
+def maximize_rows_per_page(driver, timeout=5):
+    """
+    Every page is a click and a redraw, so fewer, larger pages cut the
+    per-date wall time. Cheap when the largest size is already selected.
+    "All" renders a whole day in one page, which can exhaust the capped
+    V8 heap on busy days; it is only chosen with FLOORSHEET_ROWS_ALL=1.
+    """
+    allow_all = os.getenv("FLOORSHEET_ROWS_ALL") == "1"
+    try:
+        res = driver.execute_async_script(MAX_ROWS_PER_PAGE_JS, allow_all, timeout * 1000)
+    except WebDriverException:
+        return
+    if res and res.get("menuOpen"):
+        # Quasar closes menus on a full keydown/keyup, which a synthetic
+        # keydown alone doesn't give it
+        try:
+            driver.find_element(By.TAG_NAME, "body").send_keys(Keys.ESCAPE)
+        except WebDriverException:
+            pass
+        wait_briefly(driver, lambda d: not d.find_elements(By.CSS_SELECTOR, ".q-menu .q-item"), timeout=2)
+    if res and res["changed"]:
+        print(f"Rows per page set to {res['label']}.")
+        wait_table_ready(driver)
 
+
+def scrape_all_pages(driver, total_pages=None, page_timeout=30):
+    """
+    Returns (columns, page_count, status) after paging through the whole
+    date in a single execute_async_script call; status is 'ok', 'timeout'
+    when a click didn't change the rows, 'incomplete' when the next button
+    ran out before total_pages, or an error description.
+    """
     try:
-        if before is not None:
-            wait.until(lambda d: first_row_key(d) != before)
-        else:
-            wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "table")))
-        return True
-    except TimeoutException:
-        return "TIMEOUT"
+        res = driver.execute_async_script(SCRAPE_ALL_PAGES_JS, total_pages, page_timeout * 1000)
+    except WebDriverException as e:
+        return [], 0, f"error: {e.msg}"
+    return res["columns"], res["pages"], res["status"]
+
+
+# Resolve once the first row reads the same on two polls in a row, or give
+# up after the timeout (closed days never render a row).
+WAIT_TABLE_STABLE_JS = """
+const [timeoutMs, done] = arguments;
+const key = () => {
+    const td = document.querySelector('table tbody tr td');
+    return td ? td.innerText.trim() : null;
+};
+const start = Date.now();
+let prev = key();
+const iv = setInterval(() => {
+    const cur = key();
+    if ((cur && cur === prev) || Date.now() - start > timeoutMs) {
+        clearInterval(iv);
+        done(cur);
+    }
+    prev = cur;
+}, 200);
+"""
 
 
 def wait_table_ready(driver, timeout=40):
-    wait = WebDriverWait(driver, timeout)
+    wait = WebDriverWait(driver, timeout, poll_frequency=POLL_FREQUENCY)
     wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "table")))
 
-    # Give the body a chance to render (closed days might not have meaningful rows)
-    end = time.time() + 8
-    while time.time() < end:
-        if driver.find_elements(By.CSS_SELECTOR, "table tbody tr"):
-            break
-        time.sleep(0.2)
+    # Polled in the browser: one round-trip instead of one per poll. The
+    # budget matches the old 8 s for rows to appear plus 5 s to settle.
+    driver.execute_async_script(WAIT_TABLE_STABLE_JS, 13000)
 
-    k1 = first_row_key(driver)
-    for _ in range(25):
-        time.sleep(0.2)
-        k2 = first_row_key(driver)
-        if k2 and k2 == k1:
-            return
-        k1 = k2
+
+# ----------------------------
+# API HELPERS
+# ----------------------------
+def records_from_payload(payload):
+    """
+    The endpoint either returns a bare list of rows or wraps it in a paging
+    envelope; accept both.
+    """
+    if isinstance(payload, list):
+        return payload
+    if isinstance(payload, dict):
+        for key in ("data", "results", "content", "items", "floorsheet"):
+            rows = payload.get(key)
+            if isinstance(rows, list):
+                return rows
+            if isinstance(rows, dict):
+                return records_from_payload(rows)
+    raise ValueError("Unrecognised floorsheet API payload")
+
+
+def total_pages_from_payload(payload, size: int):
+    """
+    Page count from the paging envelope, if it carries one (either a page
+    count or a total row count).
+    """
+    if not isinstance(payload, dict):
+        return None
+
+    def _count(key):
+        v = payload.get(key)
+        return v if isinstance(v, int) and not isinstance(v, bool) else None
+
+    for key in ("last_page", "lastPage", "total_pages", "totalPages"):
+        if _count(key):
+            return _count(key)
+    for key in ("total", "count", "totalElements", "total_count", "totalRecords"):
+        if _count(key) is not None:
+            return max(1, -(-_count(key) // size))
+
+    for key in ("data", "meta", "pagination"):
+        if isinstance(payload.get(key), dict):
+            total = total_pages_from_payload(payload[key], size)
+            if total is not None:
+                return total
+    return None
+
+
+def fetch_floorsheet(session, date_str: str, page: int, size: int = API_PAGE_SIZE, timeout=30):
+    """
+    Returns (rows, total_pages); total_pages is None when the endpoint
+    doesn't report it.
+    """
+    with API_SEMAPHORE:
+        resp = session.get(
+            API_URL,
+            params={"date": date_str, "page": page, "size": size},
+            timeout=timeout,
+        )
+    resp.raise_for_status()
+    payload = orjson.loads(resp.content)
+    rows = records_from_payload(payload)
+    # A row total is split by what the server actually served: it may cap
+    # size below what was asked
+    return rows, total_pages_from_payload(payload, len(rows) or size)
+
+
+def records_to_frame(rows):
+    """
+    Numbers in the JSON stay numbers; clean_numeric_columns then only
+    coerces them instead of regex-cleaning strings. Rows that can't be
+    mapped onto HEADER raise ValueError, which sends the date to the
+    browser rather than saving misnamed or missing columns.
+    """
+    if isinstance(rows[0], dict):
+        # Key order is whatever the JSON had, so objects need an explicit
+        # mapping; from_records would also fill a misspelt key with NaN
+        if not API_FIELDS:
+            raise ValueError("API rows are objects; set FLOORSHEET_API_FIELDS to map them onto the header")
+        missing = [f for f in API_FIELDS if f not in rows[0]]
+        if missing:
+            raise ValueError(f"FLOORSHEET_API_FIELDS not in API rows: {', '.join(missing)}")
+        return pd.DataFrame.from_records(rows, columns=API_FIELDS)
+
+    df = pd.DataFrame.from_records(rows)
+    if df.shape[1] != len(HEADER):
+        raise ValueError(f"API rows have {df.shape[1]} columns, expected {len(HEADER)}")
+    return df
+
+
+def scrape_date_api(session, date_str: str, size: int = API_PAGE_SIZE):
+    rows, total_pages = fetch_floorsheet(session, date_str, 1, size)
+    print(f"Fetched API page: 1 (date {date_str})")
+    pages = [rows]
+
+    def _fetch(page):
+        page_rows, _ = fetch_floorsheet(session, date_str, page, size)
+        print(f"Fetched API page: {page} (date {date_str})")
+        return page_rows
+
+    def _check(page, rows):
+        # An endpoint that ignores the page parameter (or names it
+        # differently) serves page 1 forever; give up and use the browser
+        if page > API_MAX_PAGES:
+            raise ValueError(f"API paging passed {API_MAX_PAGES} pages; is the page parameter honoured?")
+        if rows and pages[-1] and rows[0] == pages[-1][0]:
+            raise ValueError(f"API page {page} repeats the previous page; is the page parameter honoured?")
+
+    workers = max(1, API_PAGE_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if total_pages is not None:
+            # Every remaining page is known up front
+            _check(total_pages, None)
+            for page, page_rows in enumerate(executor.map(_fetch, range(2, total_pages + 1)), start=2):
+                _check(page, page_rows)
+                pages.append(page_rows)
+        else:
+            # No page count: request the next `workers` pages at once and stop
+            # at the first empty or short one; anything past it is discarded.
+            # "Short" is against the first page, since the server may cap
+            # size. A first page under the requested size is usually the
+            # whole date, so only page 2 is probed before going wide.
+            page_size = len(rows)
+            step = workers if page_size >= size else 1
+            page = 1
+            done = page_size == 0
+            while not done:
+                first = page + 1
+                batch = list(executor.map(_fetch, range(first, first + step)))
+                page += step
+                step = workers
+                for number, rows in enumerate(batch, start=first):
+                    _check(number, rows)
+                    if rows:
+                        pages.append(rows)
+                    if len(rows) < page_size:
+                        done = True
+                        break
+
+    # One frame for the whole date rather than a frame per page plus concat
+    records = list(chain.from_iterable(pages))
+    return records_to_frame(records) if records else pd.DataFrame()
+
+
+def new_api_session():
+    session = requests.Session()
+    # Room for every concurrent page request to keep its own connection
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, API_PAGE_WORKERS))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({
+        "Accept": "application/json",
+        "Referer": URL,
+        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) floorsheet-scraper",
+    })
+
+    # Credentials captured once from a logged-in browser session, if the
+    # endpoint needs them
+    if os.getenv("FLOORSHEET_API_HEADERS"):
+        session.headers.update(json.loads(os.environ["FLOORSHEET_API_HEADERS"]))
+    if os.getenv("FLOORSHEET_API_AUTHORIZATION"):
+        session.headers["Authorization"] = os.environ["FLOORSHEET_API_AUTHORIZATION"]
+    for part in os.getenv("FLOORSHEET_API_COOKIES", "").split(";"):
+        name, sep, value = part.strip().partition("=")
+        if sep:
+            session.cookies.set(name, value)
+    return session
+
+
+def copy_browser_cookies(session, driver):
+    """
+    Let the API session ride on the cookies the SPA was given, for
+    endpoints that reject cookieless clients.
+    """
+    for cookie in driver.get_cookies():
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
 
 
 def daterange_inclusive(start_date: str, end_date: str):
@@ -351,26 +965,24 @@ def daterange_inclusive(start_date: str, end_date: str):
         d = d.fromordinal(d.toordinal() + 1)
 
 
-def main():
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-
-    npt = timezone(timedelta(hours=5, minutes=45))
-
-    start_date = os.getenv("START_DATE")
-    end_date = os.getenv("END_DATE")
-
-    if not start_date or not end_date:
-        today_npt = datetime.now(npt).strftime("%Y-%m-%d")
-        start_date = today_npt
-        end_date = today_npt
-
-    out_dir = os.path.join(BASE_DIR, "outputs", "Floor Sheet")
-    os.makedirs(out_dir, exist_ok=True)
+def clear_profile_locks(profile):
+    """
+    Drop the Singleton* lock files a crashed or killed Chrome leaves in its
+    profile (and that a restored CI cache brings from another host); Chrome
+    refuses to open a profile that still has them. Only called right before
+    this slot launches its own Chrome.
+    """
+    for name in ("SingletonLock", "SingletonSocket", "SingletonCookie"):
+        try:
+            # SingletonLock is a symlink whose target is usually gone
+            os.remove(os.path.join(profile, name))
+        except OSError:
+            pass
 
-    IS_GITHUB = os.getenv("GITHUB_ACTIONS") == "true"
 
+def build_chrome_options(slot=0):
     chrome_options = webdriver.ChromeOptions()
-    if IS_GITHUB:
+    if os.getenv("GITHUB_ACTIONS") == "true":
         chrome_options.add_argument("--headless=new")
         chrome_options.add_argument("--no-sandbox")
         chrome_options.add_argument("--disable-dev-shm-usage")
@@ -379,80 +991,579 @@ def main():
     else:
         chrome_options.add_argument("--start-maximized")
 
-    driver = webdriver.Chrome(options=chrome_options)
+    # Bound the V8 heap so a leaking tab can't take the runner down
+    chrome_options.add_argument("--js-flags=--max-old-space-size=256")
+
+    # Only the table matters; don't fetch or paint images, and skip prompts
+    chrome_options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 2,
+        "profile.default_content_setting_values.notifications": 2,
+    })
+    chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+    chrome_options.add_argument("--disable-features=TranslateUI,MediaRouter")
+
+    # Return from get()/refresh() at DOMContentLoaded; callers already wait
+    # explicitly for the table to render.
+    chrome_options.page_load_strategy = "eager"
+
+    # No Chrome/driver logging or automation infobar
+    chrome_options.add_experimental_option("excludeSwitches", ["enable-logging", "enable-automation"])
+    chrome_options.add_argument("--log-level=3")
+
+    # Keep HTTP cache, DNS and compiled JS between runs. Chrome locks a
+    # profile, so every worker slot gets its own.
+    if CHROME_PROFILE_DIR:
+        profile = os.path.join(CHROME_PROFILE_DIR, str(slot))
+        clear_profile_locks(profile)
+        chrome_options.add_argument(f"--user-data-dir={profile}")
+        chrome_options.add_argument(f"--disk-cache-dir={os.path.join(profile, 'cache')}")
+    return chrome_options
+
+
+def new_chrome(slot=0):
+    service = ChromeService(service_args=["--log-level=OFF"], log_output=subprocess.DEVNULL)
+    return webdriver.Chrome(options=build_chrome_options(slot), service=service)
+
+
+# ----------------------------
+# BROWSER SESSION REUSE
+# ----------------------------
+def session_file(slot=0):
+    return os.path.join(tempfile.gettempdir(), f"floorsheet_session_{slot}.json")
+
+
+def discard_session(slot=0):
+    """
+    Forget a REUSE_BROWSER session for good: shut down the detached
+    chromedriver that hosted it and remove its session file.
+    """
+    path = session_file(slot)
+    try:
+        with open(path, encoding="utf-8") as f:
+            executor_url = json.load(f)["executor_url"]
+        requests.get(f"{executor_url}/shutdown", timeout=2)
+    except (OSError, ValueError, KeyError, requests.RequestException):
+        pass
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def launch_chromedriver(timeout=15):
+    """
+    Start a detached chromedriver so the browser outlives this process.
+    Returns its executor URL, or None if no chromedriver binary is available.
+    """
+    binary = os.getenv("CHROMEDRIVER") or shutil.which("chromedriver")
+    if not binary:
+        return None
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    subprocess.Popen(
+        [binary, f"--port={port}", "--log-level=OFF"],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            if requests.get(f"{url}/status", timeout=1).ok:
+                return url
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return None
+
+
+def remote_chrome(executor_url, slot=0):
+    # Chrome's own connection class registers chromedriver's CDP
+    # passthrough, which a plain Remote connection doesn't know
+    return webdriver.Remote(command_executor=ChromeRemoteConnection(executor_url), options=build_chrome_options(slot))
+
+
+def attach_browser(executor_url, session_id):
+    class AttachedRemote(webdriver.Remote):
+        # Reuse the running session instead of creating a new one
+        def start_session(self, capabilities, *args, **kwargs):
+            self.session_id = session_id
+            self.caps = {}
+
+    driver = AttachedRemote(command_executor=ChromeRemoteConnection(executor_url), options=webdriver.ChromeOptions())
+    driver.current_url  # raises if the session is gone
+    return driver
+
+
+def start_shared_service():
+    """
+    One chromedriver for all parallel workers; each worker then only starts
+    its own Chrome through it. Returns None if no binary is on PATH.
+    """
+    binary = os.getenv("CHROMEDRIVER") or shutil.which("chromedriver")
+    if not binary:
+        return None
+
+    service = ChromeService(
+        executable_path=binary, service_args=["--log-level=OFF"], log_output=subprocess.DEVNULL
+    )
+    service.start()
+    return service
+
+
+def open_driver(slot=0, service_url=None):
+    """
+    Returns (driver, persistent). A persistent driver is left running at
+    exit so the next run can attach to it (REUSE_BROWSER=1).
+    """
+    if not REUSE_BROWSER:
+        if service_url:
+            return remote_chrome(service_url, slot), False
+        return new_chrome(slot), False
+
+    path = session_file(slot)
+    try:
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+        driver = attach_browser(saved["executor_url"], saved["session_id"])
+        print(f"Reusing browser session {saved['session_id']}")
+        return driver, True
+    except (OSError, ValueError, KeyError, WebDriverException):
+        pass
+
+    executor_url = launch_chromedriver()
+    if executor_url is None:
+        return new_chrome(slot), False
+
+    driver = remote_chrome(executor_url, slot)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"session_id": driver.session_id, "executor_url": executor_url}, f)
+    return driver, True
+
+
+def execute_cdp(driver, cmd, params):
+    # Remote drivers (shared service, reused sessions) have no
+    # execute_cdp_cmd; send the same passthrough command by name
+    if hasattr(driver, "execute_cdp_cmd"):
+        return driver.execute_cdp_cmd(cmd, params)
+    return driver.execute("executeCdpCommand", {"cmd": cmd, "params": params})["value"]
+
+
+def block_heavy_requests(driver):
+    urls = list(BLOCKED_URL_PATTERNS)
+    if os.getenv("FLOORSHEET_BLOCK_CSS") == "1":
+        urls.append("*.css")
+    try:
+        execute_cdp(driver, "Network.enable", {})
+        execute_cdp(driver, "Network.setBlockedURLs", {"urls": urls})
+    except WebDriverException as e:
+        print(f"Could not block subresources ({e.msg}); loading everything.")
+    except KeyError:
+        print("Driver has no CDP passthrough; loading everything.")
+
+
+def start_browser(slot=0, service_url=None):
+    driver, persistent = open_driver(slot, service_url)
     wait = WebDriverWait(driver, 30)
 
     try:
+        block_heavy_requests(driver)
+        # Async scripts (table settle, whole-date paging) bound their own waits
+        driver.set_script_timeout(3600)
+
         driver.get(URL)
         wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "table")))
+    except Exception:
+        # Nobody else holds this driver yet; left running it would also keep
+        # the slot's profile locked for the next launch
+        try:
+            driver.quit()
+        except WebDriverException:
+            pass
+        if persistent:
+            discard_session(slot)
+        raise
+    return driver, wait, persistent
 
-        dates = list(daterange_inclusive(start_date, end_date))
 
-        for idx, run_date in enumerate(dates):
-            print(f"\n=== Processing date: {run_date} ===")
+def reload_page(driver, wait):
+    driver.refresh()
+    wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "table")))
+    # The date input is the next thing pick_date needs
+    wait_briefly(driver, lambda d: find_date_input(d) is not None, timeout=10)
+
+
+def apply_date(driver, wait, run_date):
+    """
+    Switch the already-loaded page to run_date. The page is only refreshed
+    if picking fails twice in a row or the table never leaves the previous
+    date.
+    """
+    # Typically the first date of a daily run: the page opens on it
+    if date_input_matches(driver, run_date):
+        return
 
-            # Refresh before next date (as you requested)
-            if idx > 0:
-                driver.refresh()
-                wait.until(EC.presence_of_element_located((By.CSS_SELECTOR, "table")))
-                time.sleep(2)
+    before = first_row_key(driver)
 
+    for attempt in range(3):
+        try:
+            if attempt == 2:
+                print(f"Date picker stuck; refreshing page for {run_date}.")
+                reload_page(driver, wait)
             pick_date(driver, run_date, timeout=30)
-            wait_table_ready(driver, timeout=40)
+            break
+        except (TimeoutException, StaleElementReferenceException, RuntimeError):
+            if attempt == 2:
+                raise
 
-            # Quick no-row check (closed/no data)
-            if not driver.find_elements(By.CSS_SELECTOR, "table tbody tr") or not (first_row_key(driver) or "").strip():
-                print(f"NEPSE closed / no data for {run_date}. Skipping.")
-                continue
+    if not before:
+        return
 
-            out_csv = os.path.join(out_dir, f"floorsheet_{run_date}.csv")
+    if wait_briefly(driver, lambda d: first_row_key(d) != before, timeout=10) is None:
+        print(f"Table did not change for {run_date}; refreshing page.")
+        reload_page(driver, wait)
+        pick_date(driver, run_date, timeout=30)
 
-            all_data = []
-            current_page = 1
-            skip_date = False
 
-            while True:
-                all_data.extend(scrape_current_page(driver))
-                print(f"Scraped page: {current_page} (date {run_date})")
+def scrape_date_browser(driver, wait, run_date):
+    """
+    Returns the table for run_date as a DataFrame, or None when the date
+    should be skipped (market closed, paging stuck).
+    """
+    apply_date(driver, wait, run_date)
+    wait_table_ready(driver, timeout=40)
+    maximize_rows_per_page(driver)
+    ensure_first_page(driver)
+
+    # The first page's parse doubles as the no-row check (closed/no data)
+    rows, key = scrape_current_page(driver)
+    if not rows or not (key or "").strip():
+        print(f"NEPSE closed / no data for {run_date}. Skipping.")
+        return None
 
-                res = go_to_next_page(driver, wait, current_page)
+    total_pages = read_total_pages(driver)
+    columns, page_count, status = scrape_all_pages(driver, total_pages)
 
-                if res == "TIMEOUT":
-                    print(f"NEPSE closed / paging not working for {run_date}. Skipping this date.")
-                    all_data = []
-                    skip_date = True
-                    break
+    if status != "ok":
+        print(f"NEPSE closed / paging not working for {run_date} ({status}). Skipping this date.")
+        return None
 
-                if res is False:
-                    break
+    print(f"Scraped {page_count} pages (date {run_date})")
+    return pd.DataFrame(dict(enumerate(columns)))
 
-                current_page += 1
 
-            if skip_date or not all_data:
-                print(f"Skipped saving for {run_date}. Moving to next date.")
-                continue
+def clean_numeric_columns(df):
+    # One regex pass per column; anything left unparseable (empty, "1.2.3")
+    # becomes NaN. Columns that already arrived as numbers (API) are only
+    # coerced. Test for numeric rather than object dtype: pandas 3 gives
+    # scraped text the str dtype.
+    #
+    # Everything ends up float64, as the old per-cell float() did, so the
+    # CSV keeps writing 1000.0 and not 1000. Rate and Amount must not be
+    # narrowed anyway: float32 can't hold a rate like 1234.56 exactly.
+    # Quantity becomes an integer only in the Parquet copy (parquet_frame).
+    for col in NUMERIC_COLUMNS:
+        values = df[col]
+        if not pd.api.types.is_numeric_dtype(values):
+            values = values.astype(str).str.replace(_NUM_CLEAN, "", regex=True)
+        df[col] = pd.to_numeric(values, errors="coerce").astype("float64")
 
-            df = pd.DataFrame(all_data)
-            header = ["Transact No.", "Symbol", "Buyer", "Seller", "Quantity", "Rate", "Amount"]
 
-            if df.empty:
-                print(f"Empty table for {run_date}. Skipping save.")
-                continue
+def write_atomically(out_path, write):
+    """
+    Write through a sibling .part file and rename it into place, so a crash
+    mid-write never leaves a truncated output that looks finished.
+    """
+    tmp_path = out_path + ".part"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, out_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-            if df.shape[1] != len(header):
-                print(f"Column mismatch for {run_date}. Skipping this date.")
-                continue
 
-            df.columns = header
-            df["Quantity"] = df["Quantity"].apply(parse_numeric)
-            df["Rate"] = df["Rate"].apply(parse_numeric)
-            df["Amount"] = df["Amount"].apply(parse_numeric)
+def write_csv(df, out_csv):
+    # Stays on pandas: Arrow's CSV writer quotes every string and header
+    # and prints 1000.0 as 1000. With the float64 columns from
+    # clean_numeric_columns, this keeps the old file format. Use
+    # OUTPUT_FORMAT=parquet for the fast path.
+    write_atomically(out_csv, lambda f: df.to_csv(f, index=False, encoding="utf-8-sig"))
 
-            df.to_csv(out_csv, index=False, encoding="utf-8-sig")
-            print(f"Saved successfully: {out_csv}")
 
-    finally:
+def parquet_frame(df):
+    """
+    The Parquet copy of df: symbols and broker ids repeat thousands of times
+    per day, so they are dictionary-encoded, and Quantity is nullable Int32.
+    Raises ValueError if a Quantity isn't a whole number.
+    """
+    quantity = df["Quantity"]
+    if not quantity.dropna().mod(1).eq(0).all():
+        raise ValueError("fractional Quantity values")
+    out = df.astype({col: "category" for col in CATEGORY_COLUMNS})
+    out["Quantity"] = quantity.astype("Int32")
+    return out
+
+
+def write_parquet(df, out_path):
+    # df comes from parquet_frame
+    write_atomically(out_path, lambda f: df.to_parquet(f, index=False, compression="zstd"))
+
+
+def output_paths(out_dir, run_date):
+    return {fmt: os.path.join(out_dir, f"floorsheet_{run_date}.{fmt}") for fmt in OUTPUT_FORMATS}
+
+
+def save_floorsheet(df, out_paths, run_date):
+    if df.empty:
+        print(f"Empty table for {run_date}. Skipping save.")
+        return False
+
+    if df.shape[1] != len(HEADER):
+        print(f"Column mismatch for {run_date}. Skipping this date.")
+        return False
+
+    df.columns = HEADER
+    clean_numeric_columns(df)
+
+    # Convert before writing anything, so a failed cast can't leave the
+    # date with a CSV and no Parquet
+    frames = {"csv": df}
+    if "parquet" in out_paths:
+        try:
+            frames["parquet"] = parquet_frame(df)
+        except ValueError as e:
+            print(f"Cannot store {run_date} as Parquet ({e}). Skipping this date.")
+            return False
+
+    writers = {"csv": write_csv, "parquet": write_parquet}
+    for fmt, out_path in out_paths.items():
+        writers[fmt](frames[fmt], out_path)
+        print(f"Saved successfully: {out_path}")
+    return True
+
+
+def process_date(worker, run_date, out_dir):
+    """
+    Scrape and save one date using the worker's own HTTP session / browser.
+    Returns the path of the first output format, or None if the date was
+    skipped.
+    """
+    print(f"\n=== Processing date: {run_date} ===")
+
+    out_paths = output_paths(out_dir, run_date)
+    out_main = out_paths[OUTPUT_FORMATS[0]]
+
+    # Outputs are renamed into place only once complete, so existing
+    # non-empty files mean a finished date. Today's may have been saved
+    # mid-session with only part of the trades, so it is always redone.
+    is_today = run_date == datetime.now(NPT).strftime("%Y-%m-%d")
+    if not FORCE_RESCRAPE and not is_today and all(os.path.isfile(p) and os.path.getsize(p) > 0 for p in out_paths.values()):
+        print(f"Already saved: {out_main}. Skipping (set FORCE_RESCRAPE=1 to redo).")
+        return out_main
+
+    df = None
+
+    if worker["session"] is not None:
+        try:
+            df = scrape_date_api(worker["session"], run_date)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code in (401, 403) and not worker["cookies_copied"]:
+                # Bootstrap the session from the site's own cookies once
+                print(f"API refused {run_date} ({e.response.status_code}); retrying with browser cookies.")
+                driver, _ = acquire_browser(worker)
+                copy_browser_cookies(worker["session"], driver)
+                worker["cookies_copied"] = True
+                try:
+                    df = scrape_date_api(worker["session"], run_date)
+                except (requests.RequestException, ValueError) as e2:
+                    print(f"API fetch failed for {run_date} ({e2}). Falling back to browser.")
+                else:
+                    # The cookies were all it was needed for; free its slot
+                    # for workers that really have to scrape
+                    close_browser(worker, keep_persistent=False)
+            else:
+                print(f"API fetch failed for {run_date} ({e}). Falling back to browser.")
+        except (requests.RequestException, ValueError) as e:
+            print(f"API fetch failed for {run_date} ({e}). Falling back to browser.")
+
+    if df is None:
+        driver, wait = acquire_browser(worker)
+        try:
+            df = scrape_date_browser(driver, wait, run_date)
+        finally:
+            release_browser(worker)
+
+    if df is None or df.empty:
+        print(f"Skipped saving for {run_date}. Moving to next date.")
+        return None
+
+    return out_main if save_floorsheet(df, out_paths, run_date) else None
+
+
+# ----------------------------
+# BROWSER LIFECYCLE
+# ----------------------------
+def acquire_browser(worker):
+    """
+    The worker's browser, started on first use and replaced once it has
+    served BROWSER_MAX_DATES dates or lived BROWSER_MAX_AGE seconds. A
+    worker holds one of BROWSER_SLOTS while its browser is alive, waiting
+    for one if all are taken.
+    """
+    if worker["driver"] is not None:
+        age = time.time() - worker["browser_started"]
+        if worker["browser_dates"] >= BROWSER_MAX_DATES or age >= BROWSER_MAX_AGE:
+            print(f"Recycling browser after {worker['browser_dates']} dates / {int(age)}s.")
+            close_browser(worker, keep_persistent=False)
+
+    if worker["driver"] is None:
+        if not worker["browser_slot"]:
+            BROWSER_SLOTS.acquire()
+            worker["browser_slot"] = True
+        try:
+            worker["driver"], worker["wait"], worker["persistent"] = start_browser(
+                worker["slot"], worker["service_url"]
+            )
+        except Exception:
+            BROWSER_SLOTS.release()
+            worker["browser_slot"] = False
+            raise
+        worker["browser_started"] = time.time()
+        worker["browser_dates"] = 0
+
+    return worker["driver"], worker["wait"]
+
+
+def release_browser(worker):
+    worker["browser_dates"] += 1
+
+
+def close_browser(worker, keep_persistent=True):
+    driver = worker["driver"]
+    worker["driver"] = worker["wait"] = None
+    if worker["browser_slot"]:
+        BROWSER_SLOTS.release()
+        worker["browser_slot"] = False
+    if driver is None or (keep_persistent and worker["persistent"]):
+        return
+    try:
         driver.quit()
+    except WebDriverException:
+        pass
+    if worker["persistent"]:
+        discard_session(worker["slot"])
+
+
+_BROWSER_GONE = ("chrome not reachable", "tab crashed", "disconnected", "session deleted", "no such session")
+
+
+def browser_is_broken(e):
+    """
+    True for errors that mean the browser or its chromedriver is gone.
+    Timeouts and stale elements are about the page and leave it usable.
+    """
+    if isinstance(e, (InvalidSessionIdException, NoSuchWindowException)):
+        return True
+    # What Selenium's HTTP client raises once chromedriver itself is dead
+    if isinstance(e, (urllib3.exceptions.MaxRetryError, urllib3.exceptions.ProtocolError, ConnectionError)):
+        return True
+    if not isinstance(e, WebDriverException):
+        return False
+    return type(e) is WebDriverException or any(s in str(e).lower() for s in _BROWSER_GONE)
+
+
+def run_worker(slot, dates, out_dir, service_url=None):
+    # The browser is only needed when there is no API or it fails for a date
+    worker = {
+        "slot": slot,
+        "service_url": service_url,
+        "session": new_api_session() if API_URL else None,
+        "driver": None,
+        "wait": None,
+        "persistent": False,
+        "browser_slot": False,
+        "browser_started": 0.0,
+        "browser_dates": 0,
+        "cookies_copied": False,
+    }
+
+    results = []
+    try:
+        for run_date in dates:
+            # One bad date shouldn't take the rest of the slice down with it
+            try:
+                results.append(process_date(worker, run_date, out_dir))
+            except Exception as e:
+                print(f"Failed to scrape {run_date}: {e!r}. Moving to next date.")
+                results.append(None)
+                # A crashed or wedged Chrome would fail every later date too
+                if browser_is_broken(e):
+                    close_browser(worker, keep_persistent=False)
+        return results
+    finally:
+        if worker["session"] is not None:
+            worker["session"].close()
+        close_browser(worker)
+
+
+def main():
+    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+    start_date = os.getenv("START_DATE")
+    end_date = os.getenv("END_DATE")
+
+    if not start_date or not end_date:
+        today_npt = datetime.now(NPT).strftime("%Y-%m-%d")
+        start_date = today_npt
+        end_date = today_npt
+
+    unknown = set(OUTPUT_FORMATS) - {"csv", "parquet"}
+    if unknown or not OUTPUT_FORMATS:
+        raise ValueError(f"OUTPUT_FORMAT must list csv and/or parquet, got {os.getenv('OUTPUT_FORMAT')!r}")
+    if API_FIELDS and len(API_FIELDS) != len(HEADER):
+        raise ValueError(f"FLOORSHEET_API_FIELDS must name {len(HEADER)} keys ({', '.join(HEADER)}), got {len(API_FIELDS)}")
+
+    out_dir = os.path.join(BASE_DIR, "outputs", "Floor Sheet")
+    os.makedirs(out_dir, exist_ok=True)
+
+    dates = list(daterange_inclusive(start_date, end_date))
+    if not dates:
+        print(f"No dates between {start_date} and {end_date}.")
+        return
+
+    # Dates are independent; each worker owns its own session and browser and
+    # walks a contiguous slice so consecutive dates stay on one driver. Over
+    # the API a date is a few HTTP requests, so allow more of them at once.
+    default_workers = "8" if API_URL else "1"
+    workers = max(1, min(int(os.getenv("SCRAPE_WORKERS", default_workers)), len(dates)))
+    if not API_URL and workers > MAX_BROWSER_WORKERS:
+        # Past a handful of Chromes from one IP the site gets no faster
+        print(f"Capping browser workers at {MAX_BROWSER_WORKERS} (asked for {workers}).")
+        workers = MAX_BROWSER_WORKERS
+    chunk = -(-len(dates) // workers)
+    slices = [dates[i:i + chunk] for i in range(0, len(dates), chunk)]
+
+    if len(slices) == 1:
+        run_worker(0, slices[0], out_dir)
+        return
+
+    # Browser-only runs start every worker's Chrome through one chromedriver
+    service = None if (REUSE_BROWSER or API_URL) else start_shared_service()
+    service_url = service.service_url if service is not None else None
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(slices)) as executor:
+            list(executor.map(run_worker, range(len(slices)), slices, repeat(out_dir), repeat(service_url)))
+    finally:
+        if service is not None:
+            service.stop()
 
 
 if __name__ == "__main__":